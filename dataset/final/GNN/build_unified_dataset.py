@@ -2,10 +2,10 @@
 # -*- coding: utf-8 -*-
 """
 Единый датасет для GNN (внутреннее и публичное использование).
-Память: ≤ 24 ГБ за счёт итеративной обработки окон и стриминга.
+Память: ≤ 24 ГБ за счёт стриминговых запросов по всем окнам сразу.
 
 Выход: /<BASE>/gnn_dataset/
-  edges_all/edges.parquet
+  edges_all/edges_core.parquet, edges_all/edges_aux.parquet
   edges_by_month/month=YYYY-MM/edges.parquet
   edges_by_week/week=YYYY-Www/edges.parquet
   meta/month_window_meta.parquet, meta/week_window_meta.parquet
@@ -17,10 +17,18 @@
 from __future__ import annotations
 from pathlib import Path
 import os
+import subprocess
+import sys
 import polars as pl
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
 
 # --------- лимиты для RAM ---------
+# значение пользователя читаем до setdefault: только оно ограничивает фазы в run_phase
+_USER_THREADS = os.environ.get("POLARS_MAX_THREADS")
 os.environ.setdefault("POLARS_MAX_THREADS", "4")
+# большие одиночные стриминговые проходы получают все ядра (см. PHASES)
+ALL_CORES = str(os.cpu_count() or 4)
 ROW_GROUP = 256_000
 
 BASE = Path("/mnt/d/new_Fraud/dataset/final")
@@ -29,7 +37,10 @@ SRC_TX_DIR = BASE / "GNN" / "parquet"
 LABELS_CSV = BASE / "addr_labels_balanced.csv"
 
 DS_ROOT = BASE / "gnn_dataset"
-EDGES_ALL_FP = DS_ROOT / "edges_all" / "edges.parquet"
+EDGES_ALL_DIR = DS_ROOT / "edges_all"
+EDGES_CORE_FP = EDGES_ALL_DIR / "edges_core.parquet"
+EDGES_AUX_FP = EDGES_ALL_DIR / "edges_aux.parquet"
+EDGES_STAGING_FP = EDGES_ALL_DIR / "_staging_sorted.parquet"
 MONTH_DIR = DS_ROOT / "edges_by_month"
 WEEK_DIR = DS_ROOT / "edges_by_week"
 META_DIR = DS_ROOT / "meta"
@@ -38,10 +49,48 @@ MAP_DIR = DS_ROOT / "mapping"
 TARGETS_DIR = DS_ROOT / "targets"
 README_FP = DS_ROOT / "README.md"
 
-for p in [EDGES_ALL_FP.parent, MONTH_DIR, WEEK_DIR, META_DIR, LABELS_DIR, MAP_DIR, TARGETS_DIR]:
+for p in [EDGES_ALL_DIR, MONTH_DIR, WEEK_DIR, META_DIR, LABELS_DIR, MAP_DIR, TARGETS_DIR]:
     p.mkdir(parents=True, exist_ok=True)
 
-HASH_SEEDS = dict(seed=20250823, seed_1=17, seed_2=31, seed_3=73)
+# seed_1..seed_3 по умолчанию равны seed — хэшер тот же, что с 4 seed'ами, меняются
+# только значения node_id. Polars не гарантирует hash между версиями → node_id
+# воспроизводим только при той же версии Polars (и том же seed)
+HASH_SEEDS = dict(seed=20250823)
+WEI_DTYPE = pl.Decimal(38, 0)
+EDGE_COLS = ["src_id", "dst_id", "ts", "value_wei", "tx_fee_wei",
+             "block_number", "contract_creation", "tx_hash"]
+# edges_all делится на узкий core (всё, что читают оконные проходы) и aux
+# (тяжёлые строки); строки двух файлов выровнены 1:1 по позиции.
+# month/week считаются один раз здесь и хранятся в core (dictionary-encoded Utf8)
+CORE_COLS = ["src_id", "dst_id", "ts", "block_number", "contract_creation", "month", "week"]
+AUX_COLS = ["value_wei", "tx_fee_wei", "tx_hash"]
+
+
+# адрес: пробелы по краям, префикс 0x/0X, ровно 40 hex-символов в любом регистре
+ADDR_RE = r"^\s*0[xX]([0-9a-fA-F]{40})\s*$"
+
+
+def addr_bytes(col: str) -> pl.Expr:
+    # "0x" + 40 hex → 20 сырых байт; hex-декодер регистронезависим,
+    # а хэшировать 20 байт дешевле, чем 42-символьную строку.
+    # Некорректный адрес → null (не ошибка всего запроса), см. addr_invalid
+    return pl.col(col).str.extract(ADDR_RE, 1).str.decode("hex")
+
+
+def addr_invalid(col: str) -> pl.Expr:
+    # непустой адрес, не прошедший ADDR_RE (null — легитимно, напр. to у создания контракта)
+    return pl.col(col).is_not_null() & pl.col(col).str.extract(ADDR_RE, 1).is_null()
+
+
+def open_writer(fp: Path, schema) -> pq.ParquetWriter:
+    # src_id внутри месяца отсортирован → DELTA_BINARY_PACKED вместо словаря
+    opts = {}
+    if "src_id" in schema.names:
+        opts = dict(
+            use_dictionary=[c for c in schema.names if c != "src_id"],
+            column_encoding={"src_id": "DELTA_BINARY_PACKED"},
+        )
+    return pq.ParquetWriter(fp, schema, compression="zstd", write_statistics=True, **opts)
 
 
 def collect_streaming(lf: pl.LazyFrame) -> pl.DataFrame:
@@ -56,17 +105,24 @@ def collect_streaming(lf: pl.LazyFrame) -> pl.DataFrame:
 def build_labels_and_mapping():
     if not LABELS_CSV.exists():
         raise FileNotFoundError(f"Не найден labels CSV: {LABELS_CSV}")
-    lab = pl.read_csv(LABELS_CSV).with_columns(
-        pl.col("address").str.to_lowercase().alias("address_lc")
-    )
+    lab = pl.read_csv(LABELS_CSV)
+    # ручной CSV: адрес без формы 0x+40 hex не совпадёт ни с одним ребром,
+    # а его node_id был бы hash(null) — показываем такие строки и отбрасываем
+    bad = lab.filter(addr_invalid("address") | pl.col("address").is_null())
+    if bad.height:
+        print(f"[!] labels: {bad.height:,} строк с некорректным address — пропущены:")
+        print(bad.select("address").head(20))
+        lab = lab.filter(~(addr_invalid("address") | pl.col("address").is_null()))
     labels = (
         lab.select([
-            "address", "address_lc",
+            # канонический вид 0x + lowercase hex (таблица маленькая) — по нему
+            # LSTM джойнит daily-адреса
+            ("0x" + pl.col("address").str.extract(ADDR_RE, 1).str.to_lowercase()).alias("address"),
             pl.col("is_scam").cast(pl.Int8),
             pl.col("is_contract").cast(pl.Int8, strict=False),
         ])
         .with_columns([
-            pl.col("address_lc").hash(
+            addr_bytes("address").hash(
                 **HASH_SEEDS).cast(pl.UInt64).alias("node_id")
         ])
         .unique(subset=["node_id"])
@@ -89,45 +145,108 @@ def build_edges_all():
     lf_edges_all = (
         pl.scan_parquet(str(SRC_TX_DIR / "*.parquet"))
         .select(
-            pl.col("from_address").str.to_lowercase().alias("from_lc"),
-            pl.col("to_address").str.to_lowercase().alias("to_lc"),
+            addr_bytes("from_address").alias("from_b"),
+            addr_bytes("to_address").alias("to_b"),
+            # некорректные адреса получат id от null — считаем и сообщаем о них
+            (addr_invalid("from_address") | addr_invalid("to_address")).alias("_bad_addr"),
             pl.col("timestamp"),
-            pl.col("value_wei").cast(pl.Utf8).alias(
-                "value_wei"),  # строки → точность и совместимость
-            pl.col("tx_fee_wei").cast(pl.Utf8).alias("tx_fee_wei"),
+            # wei — целое ≤ 10^38 → нативный Decimal128, без строк и парсинга
+            pl.col("value_wei").cast(WEI_DTYPE).alias("value_wei"),
+            pl.col("tx_fee_wei").cast(WEI_DTYPE).alias("tx_fee_wei"),
             pl.col("block_number"),
             pl.col("contract_creation"),
             pl.col("tx_hash"),
         )
         .with_columns([
-            pl.col("from_lc").hash(
-                **HASH_SEEDS).cast(pl.UInt64).alias("src_id"),
-            pl.col("to_lc").hash(**HASH_SEEDS).cast(pl.UInt64).alias("dst_id"),
+            pl.col("from_b").hash(**HASH_SEEDS).cast(pl.UInt64).alias("src_id"),
+            pl.col("to_b").hash(**HASH_SEEDS).cast(pl.UInt64).alias("dst_id"),
             pl.col("timestamp").dt.epoch("s").cast(pl.Int64).alias("ts"),
             pl.col("block_number").cast(pl.Int64),
             pl.col("contract_creation").cast(pl.Boolean),
         ])
-        .select(["src_id", "dst_id", "ts", "value_wei", "tx_fee_wei", "block_number", "contract_creation", "tx_hash"])
+        .select(EDGE_COLS + ["_bad_addr"])
+        .with_columns([
+            pl.from_epoch("ts", time_unit="s").dt.strftime("%Y-%m").alias("month"),
+            pl.from_epoch("ts", time_unit="s").dt.strftime("%G-W%V").alias("week"),
+        ])
+        # month первым → row-group'ы выровнены по месяцам и фильтр по окну
+        # пропускает чужие группы; src_id внутри месяца → длинные серии
+        # одинаковых id у активных адресов, колонка хорошо сжимается
+        .sort(["month", "src_id", "ts"], maintain_order=True)
     )
+    # 1) отсортированный staging одним стриминговым проходом (сортировка спиллит);
+    # staging читается один раз и удаляется → lz4 вместо zstd: кодек почти
+    # бесплатен по CPU, zstd остаётся только на итоговых файлах
     lf_edges_all.sink_parquet(
-        str(EDGES_ALL_FP), compression="zstd", statistics=True)
-    print(f"[✓] edges_all → {EDGES_ALL_FP}")
+        str(EDGES_STAGING_FP), compression="lz4", statistics=True, row_group_size=ROW_GROUP)
+
+    # 2) core/aux пишутся помесячно: каждый write_table начинает новый row-group,
+    # поэтому ни один row-group не пересекает границу месяца и фильтр по окну
+    # пропускает чужие группы целиком. Строки core/aux выровнены по построению.
+    # Из того же месяца в памяти сразу пишутся edges_by_month/edges_by_week —
+    # отдельного прохода export_windows по edges_all больше нет.
+    months = collect_streaming(
+        pl.scan_parquet(str(EDGES_STAGING_FP)).select(pl.col("month").unique().sort())
+    )["month"]
+    core_w = aux_w = None
+    bad_total = 0
+    week_w = {}  # неделя может продолжаться в следующем месяце → writer открыт
+    try:
+        for month in months:
+            df = collect_streaming(
+                pl.scan_parquet(str(EDGES_STAGING_FP)).filter(pl.col("month") == month)
+            )
+            # дальше живёт только arrow-копия месяца (to_arrow может копировать строки)
+            tbl, n_edges = df.to_arrow(), df.height
+            n_bad = int(df["_bad_addr"].sum())
+            del df
+            core, aux = tbl.select(CORE_COLS), tbl.select(AUX_COLS)
+            if core_w is None:
+                core_w = open_writer(EDGES_CORE_FP, core.schema)
+                aux_w = open_writer(EDGES_AUX_FP, aux.schema)
+            core_w.write_table(core, row_group_size=ROW_GROUP)
+            aux_w.write_table(aux, row_group_size=ROW_GROUP)
+
+            month_fp = MONTH_DIR / f"month={month}" / "edges.parquet"
+            month_fp.parent.mkdir(parents=True, exist_ok=True)
+            month_tbl = tbl.select(EDGE_COLS)
+            with open_writer(month_fp, month_tbl.schema) as w:
+                w.write_table(month_tbl, row_group_size=ROW_GROUP)
+
+            # недели не идут подряд (сортировка (month, src_id, ts)), поэтому
+            # фильтруем по одной: в памяти месяц + одна неделя, а не вторая копия месяца
+            weeks = pc.unique(tbl["week"]).to_pylist()
+            for week in [w for w in week_w if w not in weeks]:
+                week_w.pop(week).close()  # неделя закончилась в прошлом месяце
+            for week in weeks:
+                part_tbl = tbl.filter(pc.equal(tbl["week"], week)).select(EDGE_COLS)
+                if week not in week_w:
+                    week_fp = WEEK_DIR / f"week={week}" / "edges.parquet"
+                    week_fp.parent.mkdir(parents=True, exist_ok=True)
+                    week_w[week] = open_writer(week_fp, part_tbl.schema)
+                week_w[week].write_table(part_tbl, row_group_size=ROW_GROUP)
+                del part_tbl
+            print(f"[edges_all] {month}: {n_edges:,} edges")
+            if n_bad:
+                print(f"[!] {month}: {n_bad:,} рёбер с некорректным адресом (src/dst_id = hash(null))")
+                bad_total += n_bad
+    finally:
+        for w in [core_w, aux_w, *week_w.values()]:
+            if w is not None:
+                w.close()
+    EDGES_STAGING_FP.unlink(missing_ok=True)
+    if bad_total:
+        print(f"[!] edges_all: всего {bad_total:,} рёбер с адресом не вида 0x+40 hex — "
+              f"проверь from_address/to_address в {SRC_TX_DIR}")
+    print(f"[✓] edges_all → {EDGES_CORE_FP.name} + {EDGES_AUX_FP.name} in {EDGES_ALL_DIR}")
+    print("[✓] edges_by_month & edges_by_week готовы")
 
 # -------------------- 3) маленький индекс окон (month/week) --------------------
 
 
 def build_window_index():
-    lf = (
-        pl.scan_parquet(str(EDGES_ALL_FP))
-        .select(
-            pl.col("ts"),
-            pl.from_epoch("ts", time_unit="s").alias("ts_dt"),
-        )
-        .with_columns([
-            pl.col("ts_dt").dt.strftime("%Y-%m").alias("month"),
-            pl.col("ts_dt").dt.strftime("%G-W%V").alias("week"),
-        ])
-    )
+    # month/week уже материализованы в core — только проекция колонок
+    lf = pl.scan_parquet(str(EDGES_CORE_FP)).select(["ts", "month", "week"])
     month_idx = collect_streaming(
         lf.group_by("month").agg([
             pl.col("ts").min().alias("window_min_ts"),
@@ -149,173 +268,123 @@ def build_window_index():
         META_DIR / "week_window_meta.parquet", compression="zstd", statistics=True)
     print(f"[✓] window index: {len(month_idx)} months, {len(week_idx)} weeks")
 
-# -------------------- 4) итеративно считаем nodes_cnt и targets per window --------------------
+# -------------------- 4) nodes_cnt и targets per window (один запрос на freq) --------------------
 
 
 def enrich_meta_and_build_targets():
-    tg_ids = pl.read_parquet(
-        LABELS_DIR / "targets_global.parquet").select("node_id").unique()
+    # маленькие таблицы читаем напрямую pyarrow — без планировщика Polars
+    tg_ids = pl.from_arrow(pq.read_table(
+        LABELS_DIR / "targets_global.parquet", columns=["node_id"])).unique()
     tg_ids = tg_ids.with_columns(pl.col("node_id").cast(pl.UInt64))  # тип явно
+    # отсортированный набор id (114k) — один на все запросы, для is_in;
+    # implode: is_in с Series того же dtype в polars>=1.x устарел (DeprecationWarning)
+    tg_set = tg_ids["node_id"].sort().implode()
 
     # helper: обработка любого freq
-    def process_freq(freq: str, meta_fp: Path, targets_out_fp: Path):
-        meta = pl.read_parquet(meta_fp).sort(freq)
-        nodes_cnt_list = []
-        targets_chunks = []
-        chunk_size = 50  # каждые 50 окон будем флэшить на диск
-
-        for i, row in enumerate(meta.iter_rows(named=True)):
-            win_id = row[freq]
-            ts_min = int(row["window_min_ts"])
-            ts_max = int(row["window_end_ts"])
-
-            # Рёбра окна (только нужный ts-диапазон)
-            lf_win = (
-                pl.scan_parquet(str(EDGES_ALL_FP))
-                .filter((pl.col("ts") >= ts_min) & (pl.col("ts") <= ts_max))
-                .select([pl.col("src_id").cast(pl.UInt64), pl.col("dst_id").cast(pl.UInt64)])
+    def process_freq(freq: str, meta_fp: Path, targets_fp: Path):
+        # (окно, node_id) для обоих концов ребра — ключ окна уже лежит в core,
+        # вместо отдельного Polars-запроса на каждое окно из Python-цикла
+        lf_nodes = pl.concat([
+            pl.scan_parquet(str(EDGES_CORE_FP)).select(
+                pl.col(freq),
+                pl.col(col).cast(pl.UInt64).alias("node_id"),
             )
+            for col in ("src_id", "dst_id")
+        ], how="vertical")
+
+        # Число узлов окна — HyperLogLog-оценка, без полного unique() по окну
+        lf_cnt = lf_nodes.group_by(freq).agg(
+            pl.col("node_id").approx_n_unique().alias("nodes_cnt"))
+        # targets окна = is_in по tg_set — без hash-join с правой таблицей;
+        # один sink на весь freq → один файл без дозаписи и перечитывания
+        lf_targets = (
+            lf_nodes.filter(pl.col("node_id").is_in(tg_set))
+            .unique()
+            .sort([freq, "node_id"])
+            .sink_parquet(str(targets_fp), compression="zstd", statistics=True,
+                          row_group_size=ROW_GROUP, lazy=True)
+        )
+        nodes_cnt, _ = pl.collect_all([lf_cnt, lf_targets], engine="streaming")
 
-            # Уникальные узлы окна (только внутри окна → дёшево)
-            nodes_win = collect_streaming(
-                pl.concat([
-                    lf_win.select(pl.col("src_id").alias("node_id")),
-                    lf_win.select(pl.col("dst_id").alias("node_id")),
-                ], how="vertical").unique()
-            )
-            nodes_cnt_list.append((win_id, len(nodes_win)))
-
-            # targets окна = пересечение с tg_ids (114k) — дешёво
-            targets_win = nodes_win.join(tg_ids, on="node_id", how="inner")
-            if targets_win.height > 0:
-                targets_win = targets_win.with_columns(
-                    pl.lit(win_id).alias(freq)).select([freq, "node_id"])
-                targets_chunks.append(targets_win)
-
-            # периодически флашим targets, чтобы не держать много в RAM
-            if len(targets_chunks) >= chunk_size:
-                df = pl.concat(targets_chunks, how="vertical")
-                mode = "wb" if not targets_out_fp.exists() else "ab"
-                # Политика: пишем одним файлом — проще для downstream
-                if not targets_out_fp.exists():
-                    df.write_parquet(
-                        targets_out_fp, compression="zstd", statistics=True)
-                else:
-                    # Append: polars напрямую не аппендит в parquet.
-                    # Решение: читаем старое быстро (это нечасто) и дописываем объединённое.
-                    old = pl.read_parquet(targets_out_fp)
-                    pl.concat([old, df], how="vertical").write_parquet(
-                        targets_out_fp, compression="zstd", statistics=True)
-                targets_chunks = []
-
-            if (i + 1) % 25 == 0:
-                print(f"[{freq}] processed {i+1}/{meta.height} windows")
-
-        # финальный флаш targets
-        if targets_chunks:
-            df = pl.concat(targets_chunks, how="vertical")
-            if not targets_out_fp.exists():
-                df.write_parquet(
-                    targets_out_fp, compression="zstd", statistics=True)
-            else:
-                old = pl.read_parquet(targets_out_fp)
-                pl.concat([old, df], how="vertical").write_parquet(
-                    targets_out_fp, compression="zstd", statistics=True)
-
-        # записываем nodes_cnt обратно в meta (не держим гигантов)
-        if nodes_cnt_list:
-            add = pl.DataFrame({freq: [a for a, _ in nodes_cnt_list], "nodes_cnt": [
-                               b for _, b in nodes_cnt_list]})
-            meta_new = meta.join(add, on=freq, how="left")
-            meta_new.write_parquet(
-                meta_fp, compression="zstd", statistics=True)
-            print(f"[✓] {freq}: nodes_cnt filled; targets → {targets_out_fp}")
+        # записываем nodes_cnt обратно в meta
+        meta = pl.from_arrow(pq.read_table(meta_fp)).sort(
+            freq).drop("nodes_cnt", strict=False)
+        meta_new = meta.join(nodes_cnt, on=freq, how="left")
+        meta_new.write_parquet(meta_fp, compression="zstd", statistics=True)
+        print(f"[✓] {freq}: nodes_cnt filled; targets → {targets_fp}")
 
     process_freq("month", META_DIR / "month_window_meta.parquet",
                  TARGETS_DIR / "month_targets.parquet")
-    process_freq("week",  META_DIR / "week_window_meta.parquet",
+    process_freq("week", META_DIR / "week_window_meta.parquet",
                  TARGETS_DIR / "week_targets.parquet")
 
-# -------------------- 5) экспорт помесячных/понедельных (низкая память) --------------------
-
-
-def export_windows():
-    month_meta = pl.read_parquet(
-        META_DIR / "month_window_meta.parquet").sort("month")
-    for month, ts_min, ts_max in zip(month_meta["month"], month_meta["window_min_ts"], month_meta["window_end_ts"]):
-        out_dir = MONTH_DIR / f"month={month}"
-        out_dir.mkdir(parents=True, exist_ok=True)
-        out_fp = out_dir / "edges.parquet"
-        if out_fp.exists():
-            continue
-        lf = (
-            pl.scan_parquet(str(EDGES_ALL_FP))
-              .filter((pl.col("ts") >= int(ts_min)) & (pl.col("ts") <= int(ts_max)))
-              .select(["src_id", "dst_id", "ts", "value_wei", "tx_fee_wei", "block_number", "contract_creation", "tx_hash"])
-        )
-        df = collect_streaming(lf)
-        df.write_parquet(out_fp, compression="zstd",
-                         statistics=True, row_group_size=ROW_GROUP)
-
-    week_meta = pl.read_parquet(
-        META_DIR / "week_window_meta.parquet").sort("week")
-    for week, ts_min, ts_max in zip(week_meta["week"], week_meta["window_min_ts"], week_meta["window_end_ts"]):
-        out_dir = WEEK_DIR / f"week={week}"
-        out_dir.mkdir(parents=True, exist_ok=True)
-        out_fp = out_dir / "edges.parquet"
-        if out_fp.exists():
-            continue
-        lf = (
-            pl.scan_parquet(str(EDGES_ALL_FP))
-              .filter((pl.col("ts") >= int(ts_min)) & (pl.col("ts") <= int(ts_max)))
-              .select(["src_id", "dst_id", "ts", "value_wei", "tx_fee_wei", "block_number", "contract_creation", "tx_hash"])
-        )
-        df = collect_streaming(lf)
-        df.write_parquet(out_fp, compression="zstd",
-                         statistics=True, row_group_size=ROW_GROUP)
-
-    print("[✓] edges_by_month & edges_by_week готовы")
-
-# -------------------- 6) README --------------------
+# -------------------- 5) README --------------------
 
 
 def write_readme():
     README_FP.write_text(f"""# Fraud LSTM+GNN — Unified Dataset (gnn_dataset)
 
 ## Состав
-- `edges_all/edges.parquet` — **все** транзакции одним файлом.
+- `edges_all/edges_core.parquet` — **все** транзакции: `src_id, dst_id, ts, block_number, contract_creation, month, week`.
+- `edges_all/edges_aux.parquet` — `value_wei, tx_fee_wei, tx_hash`; строки выровнены 1:1 с `edges_core`
+  (склейка: `pl.concat([core, aux], how="horizontal")`).
 - `edges_by_month/month=YYYY-MM/edges.parquet` — транзакции за месяц.
 - `edges_by_week/week=YYYY-Www/edges.parquet` — транзакции за ISO‑неделю.
-- `meta/month_window_meta.parquet`, `meta/week_window_meta.parquet` — интервалы `ts` и статистики.
+- `meta/month_window_meta.parquet`, `meta/week_window_meta.parquet` — интервалы `ts` и статистики
+  (`nodes_cnt` — оценка HyperLogLog, погрешность ~1%).
 - `labels/targets_global.parquet` — метки адресов: `(node_id, is_scam, is_contract, address)`.
 - `mapping/address_id_map_labels.parquet` — `(address, node_id)` для адресов из labels.
 - `targets/month_targets.parquet`, `targets/week_targets.parquet` — `(окно, node_id)` для обучения.
 
 ## Схема edges
-- `src_id`: UInt64 — детерминированный хэш от `lower(address)` (seed=20250823/17/31/73).
+- `src_id`: UInt64 — детерминированный хэш от 20 байт адреса (hex-decode без `0x`, `hash(seed=20250823)`).
+  Значения зависят от версии Polars (hash не стабилен между версиями) — сравнивай id только внутри одной сборки.
+  Адрес нормализуется (пробелы, `0x`/`0X`, регистр); адрес не вида `0x`+40 hex даёт id от null — сборка печатает их число.
 - `dst_id`: UInt64
 - `ts`: Int64 — Unix‑время (секунды).
-- `value_wei`: Utf8 — точное значение wei (строка).
-- `tx_fee_wei`: Utf8 — точное значение комиссии в wei (строка).
+- `value_wei`: Decimal(38,0) — точное значение wei.
+- `tx_fee_wei`: Decimal(38,0) — точное значение комиссии в wei.
 - `block_number`: Int64
 - `contract_creation`: Boolean
 - `tx_hash`: Utf8
+- `month`: Utf8 `YYYY-MM`, `week`: Utf8 `YYYY-Www` (ISO) — ключи окон, только в `edges_core`.
 
 ## Примечания
 - Транзакции **не фильтровались**: в `edges_*` входят все рёбра.
 - Лосс в обучении считаем **только** по адресам из `labels/targets_global.parquet`.
+- Рёбра отсортированы по `(month, src_id, ts)`.
 - Для динамики используйте `edges_by_month/*` или `edges_by_week/*`,
-  либо фильтруйте `edges_all/edges.parquet` по `ts` (predicate‑pushdown поддерживается).
+  либо фильтруйте `edges_all/edges_core.parquet` по `ts` (predicate‑pushdown поддерживается).
 """, encoding="utf-8")
     print(f"[✓] README → {README_FP}")
 
 
 # -------------------- main --------------------
+# (фаза, функция, POLARS_MAX_THREADS). Polars фиксирует размер пула потоков
+# при старте процесса, поэтому каждая фаза запускается отдельным subprocess.
+PHASES = [
+    ("labels", build_labels_and_mapping, "4"),
+    ("edges_all", build_edges_all, ALL_CORES),        # + edges_by_month / edges_by_week
+    ("window_index", build_window_index, ALL_CORES),  # маленький список окон (ts_min/max)
+    ("enrich", enrich_meta_and_build_targets, "4"),     # nodes_cnt + targets per window
+    ("readme", write_readme, "4"),
+]
+
+
+def run_phase(name: str, threads: str):
+    # POLARS_MAX_THREADS из окружения — верхний предел (способ снизить память):
+    # фаза получает min(своё значение, заданное пользователем)
+    if _USER_THREADS and _USER_THREADS.isdigit():
+        threads = str(min(int(threads), int(_USER_THREADS)))
+    env = {**os.environ, "POLARS_MAX_THREADS": threads}
+    subprocess.run([sys.executable, __file__, name], env=env, check=True)
+
+
 if __name__ == "__main__":
-    build_labels_and_mapping()
-    build_edges_all()
-    build_window_index()                 # маленький список окон (ts_min/max)
-    enrich_meta_and_build_targets()      # итеративно: nodes_cnt + targets per window
-    export_windows()                     # помесячно/понедельно → по одному окну
-    write_readme()
-    print(f"\n[✓] Единый датасет готов → {DS_ROOT}")
+    if len(sys.argv) > 1:
+        # одна фаза: python build_unified_dataset.py <phase>
+        dict((name, fn) for name, fn, _ in PHASES)[sys.argv[1]]()
+    else:
+        for name, _, threads in PHASES:
+            run_phase(name, threads)
+        print(f"\n[✓] Единый датасет готов → {DS_ROOT}")
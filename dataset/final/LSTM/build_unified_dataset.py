@@ -1,7 +1,10 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
-LSTM daily → weekly → monthly (sync with GNN windows) — ultra low‑mem (≤12 GB).
+LSTM daily → weekly → monthly (sync with GNN windows) — streaming, low‑mem.
+Память: данные в полёте ≈ POLARS_IDEAL_MORSEL_SIZE строк × потоки, плюс
+хэш-таблицы group_by (по числу пар node×окно). Для ≤12 ГБ на многоядерной
+машине задай POLARS_MAX_THREADS (например, 2–4).
 
 Вход:
   /mnt/d/new_Fraud/dataset/final/LSTM/parquet/*.parquet
@@ -19,13 +22,30 @@ LSTM daily → weekly → monthly (sync with GNN windows) — ultra low‑mem (
 """
 
 from __future__ import annotations
+from datetime import date
 from pathlib import Path
 import os
-import polars as pl
 
-# ---- 12 GB friendly ----
-os.environ["POLARS_MAX_THREADS"] = os.environ.get("POLARS_MAX_THREADS", "2")
-ROW_GROUP = 128_000  # маленькие row-groups снижают пиковую память при записи
+# ---- память ----
+# новый стриминговый движок читает размер морселя только из
+# POLARS_IDEAL_MORSEL_SIZE (pl.Config.set_streaming_chunk_size — для старого движка),
+# поэтому задаём его до import polars: данные в полёте ≈ морсель × потоки.
+# Потоки по умолчанию не режем (все ядра); предел — POLARS_MAX_THREADS из окружения
+os.environ.setdefault("POLARS_IDEAL_MORSEL_SIZE", "50000")
+
+import polars as pl  # после настройки окружения
+
+if hasattr(pl.Config, "set_engine_affinity"):
+    pl.Config.set_engine_affinity("streaming")
+# итоговые файлы: ~1M строк на row-group — меньше метаданных и длиннее серии
+# для zstd; стриминговый sink держит в памяти только текущую группу
+FINAL_RG = 1_000_000
+ZSTD_LEVEL = 3
+# daily-выгрузка BigQuery уже в lowercase hex → не гоняем str.to_lowercase по всей
+# колонке. Флагу доверяем без проверки (проверка = ещё один полный проход по address).
+# Если в daily есть адреса с заглавными (EIP-55 и т.п.) — ставь False: иначе их
+# строки не пройдут join с addr_map и молча выпадут из выхода
+ASSUME_ADDR_LOWER = True
 
 BASE = Path("/mnt/d/new_Fraud/dataset/final")
 SRC_LSTM_DAILY = BASE / "LSTM" / "parquet"         # твои дневные parquet-файлы
@@ -46,11 +66,6 @@ WEEKLY_OUT = OUT_DIR / "weekly.parquet"
 MONTHLY_OUT = OUT_DIR / "monthly.parquet"
 README_FP = OUT_DIR / "README.md"
 
-TMP_WEEK_DIR = OUT_DIR / "_tmp_week_parts"
-TMP_MONTH_DIR = OUT_DIR / "_tmp_month_parts"
-TMP_WEEK_DIR.mkdir(parents=True, exist_ok=True)
-TMP_MONTH_DIR.mkdir(parents=True, exist_ok=True)
-
 
 def collect_streaming(lf: pl.LazyFrame) -> pl.DataFrame:
     try:
@@ -78,46 +93,85 @@ INT_COUNTS = [
 ]
 MAX_ONLY = {"burst_max_tx_5m"}
 SUM_ONLY = (set(INT_COUNTS) - MAX_ONLY) | set(ETH_NUMS)
+# порядок колонок итоговых файлов (один раз на модуль)
+COL_ORDER = sorted(SUM_ONLY | MAX_ONLY)
+WEEKLY_SELECT = ["node_id", "week"] + COL_ORDER
+MONTHLY_SELECT = ["node_id", "month"] + COL_ORDER
 
-# ============== 1) targets + mapping ==============
+# ============== 1) mapping ==============
 if not LABELS_FP.exists() or not MAP_FP.exists():
     raise FileNotFoundError(
         "Не найдены labels/mapping в gnn_dataset. Сначала собери GNN gnn_dataset.")
-targets = pl.read_parquet(LABELS_FP).select(
-    ["node_id", "address"]).with_columns(pl.col("address").str.to_lowercase())
-addr_map = pl.read_parquet(MAP_FP).with_columns(
-    pl.col("address").str.to_lowercase()).unique(subset=["address"])
+# в память — только две колонки, нужные для join
+addr_map = collect_streaming(
+    pl.scan_parquet(MAP_FP)
+      .select(["address", "node_id"])
+      .with_columns(pl.col("address").str.to_lowercase())
+      .unique(subset=["address"])
+)
 
 # ============== 2) daily → filtered + node_id + week/month (streaming) ==============
 if not any(SRC_LSTM_DAILY.glob("*.parquet")):
     raise FileNotFoundError(
         f"Не найдены входные daily parquet в {SRC_LSTM_DAILY}")
 
-# Берём только реально существующие колонки, не дергая полную схему (без предупреждения)
+# Берём только реально существующие колонки; daily-файлы однородны, поэтому
+# схема читается из футера одного файла, а не из всех
+sample_fp = next(SRC_LSTM_DAILY.glob("*.parquet"))
 src_scan = pl.scan_parquet(str(SRC_LSTM_DAILY / "*.parquet"))
-src_schema = src_scan.collect_schema()
+src_schema = pl.scan_parquet(sample_fp).collect_schema()
 needed = ["address", "day"] + \
     [c for c in (INT_COUNTS + ETH_NUMS) if c in src_schema]
-lf_daily = (
-    src_scan
-    .select(needed)
-    .with_columns(pl.col("address").str.to_lowercase())
-    # только целевые адреса; добавит node_id
-    .join(addr_map.lazy(), on="address", how="inner")
+# календарь день → окна (≈4 тыс. строк с генезиса Ethereum): strftime считается
+# по разу на день календаря, а не на каждую daily-строку.
+# week_id — номер ISO-недели от эпохи (1970-01-01 — четверг, +3 выравнивает на пн),
+# month_id = year*12 + month-1; по целым ключам идут group_by/join ниже
+calendar = (
+    pl.DataFrame({"day": pl.date_range(date(2015, 7, 30), date.today(), eager=True)})
     .with_columns([
-        pl.col("day").cast(pl.Date),
         pl.col("day").dt.strftime("%G-W%V").alias("week"),
         pl.col("day").dt.strftime("%Y-%m").alias("month"),
+        ((pl.col("day").dt.epoch("d") + 3) // 7).cast(pl.Int32).alias("week_id"),
+        (pl.col("day").dt.year() * 12 + pl.col("day").dt.month() - 1)
+        .cast(pl.Int32).alias("month_id"),
     ])
-    .select(["node_id", "address", "day", "week", "month"] + [c for c in needed if c not in {"address", "day"}])
 )
-lf_daily.sink_parquet(str(DAILY_OUT), compression="zstd", statistics=True)
+
+lf_daily = src_scan.select(needed)
+if not ASSUME_ADDR_LOWER:
+    lf_daily = lf_daily.with_columns(pl.col("address").str.to_lowercase())
+lf_daily = (
+    lf_daily
+    # фильтр по адресу уходит в parquet-скан: сначала декодируется address,
+    # метрики — только для строк целевых адресов (остальные не распаковываются)
+    .filter(pl.col("address").is_in(addr_map["address"].implode()))
+    # добавит node_id
+    .join(addr_map.lazy(), on="address", how="inner")
+    .with_columns(pl.col("day").cast(pl.Date))
+    # ключи окон (week_id/month_id и строки week/month) — join с маленьким календарём
+    .join(calendar.lazy(), on="day", how="left")
+    .select(["node_id", "address", "day", "week", "month", "week_id", "month_id"]
+            + [c for c in needed if c not in {"address", "day"}])
+)
+lf_daily.sink_parquet(str(DAILY_OUT), compression="zstd", compression_level=ZSTD_LEVEL,
+                      statistics=True, row_group_size=FINAL_RG)
 print(f"[✓] daily_filtered → {DAILY_OUT}")
 
-# ============== 3) weekly — ПО ОКНАМ (низкая память) ==============
+# компактная таблица соответствия (week → month) из уже сохранённого daily_filtered
+week_month_map = collect_streaming(
+    pl.scan_parquet(str(DAILY_OUT))
+      .select(["week_id", "month_id", "week", "month"])
+      .unique()      # это маленькая таблица (по числу недель)
+)
+
+# ============== 3) weekly — один стриминговый group_by ==============
 if not WEEK_META.exists():
     raise FileNotFoundError(WEEK_META)
-weeks_list = pl.read_parquet(WEEK_META).select("week").to_series().to_list()
+# окна из meta — semi-join по таблицам, без Python-списков
+week_names = (
+    week_month_map.join(pl.read_parquet(WEEK_META, columns=["week"]), on="week", how="semi")
+    .select(["week_id", "week"]).unique()
+)
 
 # агрегации
 
@@ -130,59 +184,43 @@ def max_int(c): return pl.col(c).cast(
     pl.Int64, strict=False).fill_null(0).max().alias(c)
 
 
-def sum_dec_str(c): return pl.col(c).cast(pl.Decimal(38, 9),
-                                          strict=False).fill_null(0).sum().cast(pl.Utf8).alias(c)
+def sum_dec(c): return pl.col(c).cast(pl.Decimal(38, 9),
+                                      strict=False).fill_null(0).sum().alias(c)
 
 
 weekly_aggs = []
 for c in SUM_ONLY:
     if c in ETH_NUMS:
-        weekly_aggs.append(sum_dec_str(c))
+        weekly_aggs.append(sum_dec(c))
     else:
         weekly_aggs.append(sum_int(c))
 for c in MAX_ONLY:
     weekly_aggs.append(max_int(c))
 
-# считаем каждую неделю отдельно и пишем part-файлы
-for i, w in enumerate(weeks_list, 1):
-    part_fp = TMP_WEEK_DIR / f"week={w}.parquet"
-    if part_fp.exists():
-        if i % 50 == 0:
-            print(f"[weekly] skip {i}/{len(weeks_list)}")
-        continue
-    lf_part = (
-        pl.scan_parquet(str(DAILY_OUT))
-          .filter(pl.col("week") == w)
-          .group_by(["node_id", "week"])
-          .agg(weekly_aggs)
-          .select(["node_id", "week"] + sorted(SUM_ONLY | MAX_ONLY))
-    )
-    # маленький фрейм → пишем напрямую
-    collect_streaming(lf_part).write_parquet(
-        part_fp, compression="zstd", statistics=True, row_group_size=ROW_GROUP)
-    if i % 50 == 0:
-        print(f"[weekly] {i}/{len(weeks_list)}")
-
-# объединяем все weekly-парты в один файл стримингом
-parts = sorted(TMP_WEEK_DIR.glob("week=*.parquet"))
-if parts:
-    pl.scan_parquet([str(p) for p in parts]).sink_parquet(
-        str(WEEKLY_OUT), compression="zstd", statistics=True)
+# все недели одним проходом по daily: стриминговый движок агрегирует
+# по морселям и спиллит при нехватке памяти, без N повторных сканов
+(
+    pl.scan_parquet(str(DAILY_OUT))
+      .filter(pl.col("week_id").is_in(week_names["week_id"].implode()))
+      .group_by(["node_id", "week_id"])
+      .agg(weekly_aggs)
+      .join(week_names.lazy(), on="week_id", how="inner")
+      .select(WEEKLY_SELECT)
+      .sort(["week", "node_id"])
+      .sink_parquet(str(WEEKLY_OUT), compression="zstd", compression_level=ZSTD_LEVEL,
+                    statistics=True, row_group_size=FINAL_RG, engine="streaming")
+)
 print(f"[✓] weekly → {WEEKLY_OUT}")
 
-# ============== 4) month — ИЗ НЕДЕЛЬ (низкая память) ==============
+# ============== 4) month — ИЗ НЕДЕЛЬ (один join + group_by) ==============
 if not MONTH_META.exists():
     raise FileNotFoundError(MONTH_META)
 
-# компактная таблица соответствия (week → month) из уже сохранённого daily_filtered
-week_month_map = (
-    pl.scan_parquet(str(DAILY_OUT))
-      .select(["week", "month"])
-      .unique()
-      .collect()     # это маленькая таблица (по числу недель)
+month_weeks = (
+    week_month_map.join(pl.read_parquet(MONTH_META, columns=["month"]), on="month", how="semi")
+    .select(["week", "month_id"])
 )
-
-months_list = pl.read_parquet(MONTH_META).select("month").to_series().to_list()
+month_names = week_month_map.select(["month_id", "month"]).unique()
 
 # При агрегации по месяцам:
 
@@ -191,8 +229,7 @@ def sum_int_m(c): return pl.col(c).cast(
     pl.Int64, strict=False).fill_null(0).sum().alias(c)
 
 
-def sum_dec_str_m(c): return pl.col(c).cast(pl.Utf8).cast(
-    pl.Decimal(38, 9), strict=False).fill_null(0).sum().cast(pl.Utf8).alias(c)
+def sum_dec_m(c): return pl.col(c).fill_null(0).sum().alias(c)
 
 
 def max_int_m(c): return pl.col(c).cast(
@@ -202,44 +239,26 @@ def max_int_m(c): return pl.col(c).cast(
 monthly_aggs = []
 for c in SUM_ONLY:
     if c in ETH_NUMS:
-        # weekly-значения строковые → обратно в Decimal → sum → строка
-        monthly_aggs.append(sum_dec_str_m(c))
+        # weekly-значения уже Decimal(38,9) → сумма без парсинга
+        monthly_aggs.append(sum_dec_m(c))
     else:
         monthly_aggs.append(sum_int_m(c))
 for c in MAX_ONLY:
     monthly_aggs.append(max_int_m(c))
 
-for i, m in enumerate(months_list, 1):
-    part_fp = TMP_MONTH_DIR / f"month={m}.parquet"
-    if part_fp.exists():
-        if i % 25 == 0:
-            print(f"[monthly] skip {i}/{len(months_list)}")
-        continue
-
-    # недели, входящие в месяц m
-    w_in_m = week_month_map.filter(pl.col("month") == m).select(
-        "week").to_series().to_list()
-    if not w_in_m:
-        continue
-
-    lf_m = (
-        pl.scan_parquet(str(WEEKLY_OUT))
-          .filter(pl.col("week").is_in(w_in_m))
-          .group_by("node_id")
-          .agg(monthly_aggs)
-          .with_columns(pl.lit(m).alias("month"))
-          .select(["node_id", "month"] + sorted(SUM_ONLY | MAX_ONLY))
-    )
-    collect_streaming(lf_m).write_parquet(
-        part_fp, compression="zstd", statistics=True, row_group_size=ROW_GROUP)
-    if i % 25 == 0:
-        print(f"[monthly] {i}/{len(months_list)}")
-
-# объединяем все monthly-парты в один файл
-parts_m = sorted(TMP_MONTH_DIR.glob("month=*.parquet"))
-if parts_m:
-    pl.scan_parquet([str(p) for p in parts_m]).sink_parquet(
-        str(MONTHLY_OUT), compression="zstd", statistics=True)
+# неделя на стыке месяцев входит в оба месяца: join по week размножает
+# её строку на каждый месяц из week_month_map — один скан weekly на все месяцы
+(
+    pl.scan_parquet(str(WEEKLY_OUT))
+      .join(month_weeks.lazy(), on="week", how="inner")
+      .group_by(["node_id", "month_id"])
+      .agg(monthly_aggs)
+      .join(month_names.lazy(), on="month_id", how="inner")
+      .select(MONTHLY_SELECT)
+      .sort(["month", "node_id"])
+      .sink_parquet(str(MONTHLY_OUT), compression="zstd", compression_level=ZSTD_LEVEL,
+                    statistics=True, row_group_size=FINAL_RG, engine="streaming")
+)
 print(f"[✓] monthly → {MONTHLY_OUT}")
 
 # ============== 5) README.md ==============
@@ -247,12 +266,13 @@ README_FP.write_text(
     "# 📊 Fraud LSTM Dataset\n\n"
     "Датасет для обучения LSTM, синхронизирован с GNN (`gnn_dataset`) по адресам (`node_id`) и окнам (`week`, `month`).\n\n"
     "## Файлы\n"
-    "- `daily_filtered.parquet` — дневные фичи только для целевых адресов, с колонками `node_id`, `address`, `day`, `week`, `month`.\n"
+    "- `daily_filtered.parquet` — дневные фичи только для целевых адресов, с колонками `node_id`, `address`, `day`, `week`, `month`, `week_id`, `month_id`.\n"
+    "  `week_id = (дни от 1970-01-01 + 3) // 7` (ISO‑неделя), `month_id = year*12 + month - 1`.\n"
     "- `weekly.parquet` — агрегаты по ISO‑неделям (YYYY-Www).\n"
     "- `monthly.parquet` — агрегаты по месяцам (YYYY-MM), собраны **из недель**.\n\n"
     "## Агрегации\n"
     "- Все счётчики суммируются.\n"
-    "- ETH‑поля суммируются как Decimal(38,9) и сохраняются строкой (без потери точности).\n"
+    "- ETH‑поля суммируются и хранятся как Decimal(38,9) (без потери точности).\n"
     "- `burst_max_tx_5m` — берём максимум в окне.\n\n"
     "## Синхронизация\n"
     "- Совпадающие `node_id` с `gnn_dataset/labels/targets_global.parquet`.\n"
@@ -261,6 +281,4 @@ README_FP.write_text(
 )
 print(f"[✓] README → {README_FP}")
 
-print(f"\n[✓] LSTM dataset ready → {OUT_DIR}\n"
-      f"    weekly parts:  {TMP_WEEK_DIR}\n"
-      f"    monthly parts: {TMP_MONTH_DIR}\n")
+print(f"\n[✓] LSTM dataset ready → {OUT_DIR}\n")
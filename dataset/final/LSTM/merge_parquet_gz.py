@@ -4,16 +4,28 @@
 Особенности:
 - Автодетект формата: gzip vs parquet по сигнатурам (без доверия к расширению).
 - Если уже parquet — читаем файл напрямую (без копирования/удаления).
-- Если gzip — распаковываем во временный .parquet, читаем и удаляем tmp.
+- Если gzip — распаковываем в память (pa.BufferReader), если распакованный
+  размер (ISIZE из хвоста gzip) влезает в бюджет RAM вместе с уже живыми
+  буферами; иначе во временный .parquet, читаем и удаляем tmp.
+  Файлы, распакованные ради схемы, переиспользуются (без второй распаковки);
+  они всегда идут через tmp, чтобы не держать все файлы в памяти разом.
 - Деление итогов по числу строк (-- MAX_ROWS_PER_FILE), запись row-group'ами.
+- Следующие файлы распаковываются фоном (пул потоков), пока текущий пишется.
+- Чтение через pyarrow.dataset (фрагмент + сканер): распаковка идёт с опережением
+  в нескольких потоках, параллельно с записью.
 """
 
 import sys
 import os
 import tempfile
 import subprocess
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.fs as pafs
 import pyarrow.parquet as pq
 
 # ====== НАСТРОЙКИ ПОД ТВОЙ КЕЙС ======
@@ -26,13 +38,71 @@ OUT_BASE = "daily_final"
 CODEC = "zstd"                  # "zstd" | "snappy" | "gzip" | "brotli" | "lz4_raw"
 MAX_ROWS_PER_FILE = 40_000_000   # 0 = всё в один файл; иначе делим по N строк
 ROW_GROUP_SIZE = 1_000_000
+BATCH_READAHEAD = 8             # сколько батчей сканер читает наперёд
+PREFETCH_FILES = 4              # сколько следующих файлов распаковываются фоном
+# (в RAM; не влезший в бюджет .gz пишется в tmp на диске не дальше чем на файл
+#  вперёд — в tmp одновременно ≤ 2 распакованных файла, при UNIFY_SCHEMAS — все)
 # быстрее распаковывать .gz, если pigz установлен (sudo apt install pigz)
 USE_PIGZ = True
 UNIFY_SCHEMAS = False           # True, если у частей могут отличаться схемы
+# .gz распаковываем в RAM, пока все живые буферы вместе ≤ свободной памяти
+# на старте / RAM_FRACTION; размер берём из ISIZE, а не угадываем
+RAM_FRACTION = 4
 # =====================================
 
 GZIP_MAGIC = b"\x1f\x8b"
 PARQUET_MAGIC = b"PAR1"
+PARQUET_FORMAT = ds.ParquetFileFormat()
+LOCAL_FS = pafs.LocalFileSystem()
+
+
+def available_ram() -> int:
+    try:
+        import psutil
+        return psutil.virtual_memory().available
+    except ImportError:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+# бюджет буферов в памяти: считается один раз, занятые байты учитываются под локом
+_ram_lock = threading.Lock()
+_ram_budget = None
+_ram_reserved = 0
+
+
+def reserve_ram(n: int) -> bool:
+    global _ram_budget, _ram_reserved
+    with _ram_lock:
+        if _ram_budget is None:
+            _ram_budget = available_ram() // RAM_FRACTION
+        if _ram_reserved + n > _ram_budget:
+            return False
+        _ram_reserved += n
+        return True
+
+
+def release_ram(n: int):
+    global _ram_reserved
+    with _ram_lock:
+        _ram_reserved -= n
+
+
+# очередь на диск: файл №i распаковывается в tmp, только когда главный поток
+# дошёл до файла №i-1 (иначе PREFETCH_FILES многогигабайтных tmp разом)
+_disk_turn = threading.Condition()
+_disk_current = -1
+
+
+def wait_disk_turn(seq: int):
+    with _disk_turn:
+        _disk_turn.wait_for(lambda: seq <= _disk_current + 1)
+
+
+def advance_disk_turn(seq: int):
+    global _disk_current
+    with _disk_turn:
+        _disk_current = seq
+        _disk_turn.notify_all()
 
 
 def head(path: Path, n: int) -> bytes:
@@ -55,28 +125,54 @@ def tail(path: Path, n: int) -> bytes:
         return b""
 
 
-def is_gzip_file(path: Path) -> bool:
-    return head(path, 2) == GZIP_MAGIC
+def gz_isize(src: Path, size: int) -> int:
+    # ISIZE (последние 4 байта gzip, LE) = распакованный размер mod 2**32;
+    # для файлов > 4 ГБ добавляем 2**32, пока оценка меньше сжатого размера.
+    # pigz/gzip пишут один member, так что ISIZE описывает весь файл
+    est = int.from_bytes(tail(src, 4), "little")
+    while est < size:
+        est += 1 << 32
+    return est
 
 
-def is_parquet_file(path: Path) -> bool:
-    return head(path, 4) == PARQUET_MAGIC and tail(path, 4) == PARQUET_MAGIC
-
-
-def get_parquet_handle(src: Path, tmpdir: Path):
+def get_parquet_handle(src: Path, tmpdir: Path, in_memory: bool = True,
+                       seq: int | None = None):
     """
-    Возвращает кортеж (path_to_parquet, is_temp).
-    - Если src.gz: распакует во временный .parquet и вернёт (tmp, True).
+    Возвращает кортеж (parquet_source, is_temp).
+    - Если src.gz, in_memory и влезает в бюджет RAM: распакует в память
+      и вернёт (pa.BufferReader, True).
+    - Если src.gz и не влезает: распакует во временный .parquet и вернёт (tmp, True);
+      с seq (номер файла в основном цикле) — дождавшись очереди на диск.
     - Если src уже parquet: вернёт (src, False).
     - Если неизвестный формат: бросит исключение.
     """
-    if src.stat().st_size == 0:
+    size = src.stat().st_size
+    if size == 0:
         raise RuntimeError(f"{src.name}: пустой файл")
 
-    if is_gzip_file(src):
+    # одно чтение заголовка на файл; хвост читаем только для parquet-кандидатов
+    sig = head(src, 16)
+    if sig[:2] == GZIP_MAGIC:
+        cmd = ["pigz" if USE_PIGZ else "gzip", "-dc", str(src)]
+        est = gz_isize(src, size)
+        if in_memory and reserve_ram(est):
+            # .gz -> память: без записи и повторного чтения tmp на диске
+            try:
+                buf = subprocess.run(cmd, stdout=subprocess.PIPE, check=True).stdout
+            except Exception:
+                release_ram(est)
+                raise
+            # резерв = фактический размер буфера (release_handle вернёт именно его)
+            release_ram(est - len(buf))
+            if not buf:
+                raise RuntimeError(
+                    f"{src.name}: после распаковки размер 0 (битый gzip?)")
+            return pa.BufferReader(buf), True
+
         # распаковываем .gz -> tmp/*.parquet
+        if seq is not None:
+            wait_disk_turn(seq)
         dst = tmpdir / src.stem  # убираем .gz
-        cmd = ["pigz" if USE_PIGZ else "gzip", "-dc", str(src)]
         with open(dst, "wb") as out:
             subprocess.run(cmd, stdout=out, check=True)
         if dst.stat().st_size == 0:
@@ -84,25 +180,48 @@ def get_parquet_handle(src: Path, tmpdir: Path):
                 f"{src.name}: после распаковки размер 0 (битый gzip?)")
         return dst, True
 
-    if is_parquet_file(src):
+    if sig[:4] == PARQUET_MAGIC and tail(src, 4) == PARQUET_MAGIC:
         # уже parquet — читаем напрямую, не трогаем оригинал
         return src, False
 
-    sig = head(src, 16)
     raise RuntimeError(
         f"{src.name}: неизвестный формат (не gzip и не parquet). First bytes: {sig!r}")
 
 
-def collect_unified_schema(files, tmpdir):
+def release_handle(loc):
+    # tmp-файл удаляем; буфер в памяти освободит сборщик мусора,
+    # его байты возвращаем в бюджет
+    if isinstance(loc, Path):
+        loc.unlink(missing_ok=True)
+    else:
+        release_ram(loc.size())
+
+
+def open_fragment(loc) -> ds.ParquetFileFragment:
+    if isinstance(loc, Path):
+        return PARQUET_FORMAT.make_fragment(str(loc), filesystem=LOCAL_FS)
+    return PARQUET_FORMAT.make_fragment(loc)
+
+
+def get_cached_handle(src: Path, tmpdir: Path, cache: dict, seq: int):
+    """
+    Как get_parquet_handle, но сначала ищет уже распакованный tmp в cache
+    (файл или буфер; заполняется при чтении схемы), чтобы не распаковывать .gz второй раз.
+    """
+    if src in cache:
+        return cache.pop(src), True
+    return get_parquet_handle(src, tmpdir, seq=seq)
+
+
+def collect_unified_schema(files, tmpdir, cache):
+    # распакованные tmp не удаляем — основной цикл возьмёт их из cache;
+    # только на диск: буферы всех файлов разом не поместились бы в RAM
     schemas = []
     for p in files:
-        loc, is_temp = get_parquet_handle(p, tmpdir)
-        try:
-            pf = pq.ParquetFile(loc)
-            schemas.append(pf.schema_arrow)
-        finally:
-            if is_temp:
-                Path(loc).unlink(missing_ok=True)
+        loc, is_temp = get_parquet_handle(p, tmpdir, in_memory=False)
+        if is_temp:
+            cache[p] = loc
+        schemas.append(pq.ParquetFile(loc).schema_arrow)
     return pa.unify_schemas(schemas)
 
 
@@ -123,17 +242,16 @@ def main():
     with tempfile.TemporaryDirectory() as td:
         tmpdir = Path(td)
 
-        # 1) Схема
+        # 1) Схема (распакованные ради неё файлы переиспользуются в шаге 2)
+        cache = {}
         if UNIFY_SCHEMAS:
             print("[i] Unifying schemas...", file=sys.stderr)
-            schema = collect_unified_schema(files, tmpdir)
+            schema = collect_unified_schema(files, tmpdir, cache)
         else:
             loc0, is_temp0 = get_parquet_handle(files[0], tmpdir)
-            try:
-                schema = pq.ParquetFile(loc0).schema_arrow
-            finally:
-                if is_temp0:
-                    Path(loc0).unlink(missing_ok=True)
+            if is_temp0:
+                cache[files[0]] = loc0
+            schema = pq.ParquetFile(loc0).schema_arrow
 
         # 2) Запись
         idx = 0
@@ -141,31 +259,55 @@ def main():
         rows_in_file = 0
         total_rows = 0
 
+        # Пул заранее распаковывает следующие PREFETCH_FILES файлов, пока главный
+        # поток читает/пишет текущий; порядок файлов сохраняется через очередь.
+        pool = ThreadPoolExecutor(max_workers=PREFETCH_FILES)
+        pending = deque()
+        files_iter = enumerate(files)
+
+        def prefetch_next():
+            i, nxt = next(files_iter, (None, None))
+            if nxt is not None:
+                pending.append(
+                    (i, nxt, pool.submit(get_cached_handle, nxt, tmpdir, cache, i)))
+
+        for _ in range(PREFETCH_FILES):
+            prefetch_next()
+
         try:
-            for p in files:
+            while pending:
+                i, p, fut = pending.popleft()
+                advance_disk_turn(i)  # следующему файлу можно на диск
+                prefetch_next()
                 try:
-                    loc, is_temp = get_parquet_handle(p, tmpdir)
+                    loc, is_temp = fut.result()
                 except Exception as e:
                     print(f"[!] Пропускаю {p.name}: {e}", file=sys.stderr)
                     continue
 
                 try:
-                    pf = pq.ParquetFile(loc)
-                    if not UNIFY_SCHEMAS and pf.schema_arrow != schema:
+                    frag = open_fragment(loc)
+                    if not UNIFY_SCHEMAS and frag.physical_schema != schema:
                         raise RuntimeError(
                             f"Schema mismatch в {p.name}. Поставь UNIFY_SCHEMAS=True.")
 
-                    for rg in range(pf.num_row_groups):
-                        tbl = pf.read_row_group(rg)
-                        if UNIFY_SCHEMAS and tbl.schema != schema:
-                            tbl = tbl.cast(schema, safe=False)
+                    # Сканер читает и распаковывает row-group'ы с опережением
+                    # в пуле потоков, пока главный поток пишет предыдущие батчи.
+                    scanner = ds.Scanner.from_fragment(
+                        frag, batch_size=ROW_GROUP_SIZE, batch_readahead=BATCH_READAHEAD,
+                        use_threads=True)
+                    for batch in scanner.to_batches():
+                        if batch.num_rows == 0:
+                            continue
+                        if UNIFY_SCHEMAS and batch.schema != schema:
+                            batch = batch.cast(schema, safe=False)
 
                         # Деление по MAX_ROWS_PER_FILE
-                        if MAX_ROWS_PER_FILE and rows_in_file + tbl.num_rows > MAX_ROWS_PER_FILE:
+                        if MAX_ROWS_PER_FILE and rows_in_file + batch.num_rows > MAX_ROWS_PER_FILE:
                             need = MAX_ROWS_PER_FILE - rows_in_file
                             if need > 0:
-                                writer.write_table(
-                                    tbl.slice(0, need), row_group_size=ROW_GROUP_SIZE)
+                                writer.write_batch(
+                                    batch.slice(0, need), row_group_size=ROW_GROUP_SIZE)
                                 total_rows += need
                             writer.close()
                             print(f"[i] wrote {current.name}", file=sys.stderr)
@@ -174,21 +316,23 @@ def main():
                             writer, current = open_new_writer(idx, schema)
                             rows_in_file = 0
 
-                            rest = tbl.slice(need)
+                            rest = batch.slice(need)
                             if rest.num_rows > 0:
-                                writer.write_table(
+                                writer.write_batch(
                                     rest, row_group_size=ROW_GROUP_SIZE)
                                 rows_in_file += rest.num_rows
                                 total_rows += rest.num_rows
                         else:
-                            writer.write_table(
-                                tbl, row_group_size=ROW_GROUP_SIZE)
-                            rows_in_file += tbl.num_rows
-                            total_rows += tbl.num_rows
+                            writer.write_batch(
+                                batch, row_group_size=ROW_GROUP_SIZE)
+                            rows_in_file += batch.num_rows
+                            total_rows += batch.num_rows
                 finally:
                     if is_temp:
-                        Path(loc).unlink(missing_ok=True)
+                        release_handle(loc)
         finally:
+            advance_disk_turn(len(files))  # не оставляем воркеров ждать очереди
+            pool.shutdown(wait=True, cancel_futures=True)
             writer.close()
             print(f"[i] wrote {current.name}", file=sys.stderr)
 
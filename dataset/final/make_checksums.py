@@ -10,9 +10,10 @@ Outputs (written next to BASE):
 
 Usage:
   python3 make_checksums.py                             # generate
-  python3 make_checksums.py --verify                    # verify against existing CHECKSUMS.md
+  python3 make_checksums.py --verify                    # verify against manifest.jsonl (or CHECKSUMS.md)
   python3 make_checksums.py --base /path/to/final       # custom base dir
   python3 make_checksums.py --include-md5               # also compute md5
+  python3 make_checksums.py --force                     # re-hash files unchanged since last manifest
 
 Default BASE:
   /mnt/d/new_Fraud/dataset/final
@@ -20,6 +21,8 @@ Default BASE:
 
 from __future__ import annotations
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 import argparse
 import hashlib
 import json
@@ -35,6 +38,44 @@ MANIFEST_NAME = "manifest.jsonl"
 SKIP_DIR_NAMES = {".git", "__pycache__", "_tmp_week_parts", "_tmp_month_parts"}
 SKIP_FILE_SUFFIXES = {".tmp", ".part"}
 
+# read buffer for the manual hashing loops (parquet files are MB..GB)
+READ_BUF = 4 * 1024 * 1024
+
+
+def _openssl_ge_3() -> bool:
+    try:
+        import ssl
+        return ssl.OPENSSL_VERSION_INFO >= (3, 0)
+    except ImportError:  # Python built without ssl
+        return False
+
+
+class _CryptoSha256:
+    # hashlib-like wrapper over cryptography's OpenSSL Hash (SHA-NI / ARMv8 CE)
+    def __init__(self):
+        self._h = _chashes.Hash(_chashes.SHA256())
+
+    def update(self, data):
+        self._h.update(data)
+
+    def hexdigest(self) -> str:
+        return self._h.finalize().hex()
+
+
+# hashlib on OpenSSL >= 3 already uses SHA extensions; older/no-SSL builds may
+# fall back to generic C SHA-256, so prefer `cryptography` if it is installed
+SHA256 = "sha256"
+if not _openssl_ge_3():
+    try:
+        from cryptography.hazmat.primitives import hashes as _chashes
+        SHA256 = _CryptoSha256
+    except ImportError:
+        pass
+
+
+def new_sha256():
+    return hashlib.new(SHA256) if isinstance(SHA256, str) else SHA256()
+
 
 def human_bytes(n: int) -> str:
     # pretty size
@@ -47,34 +88,103 @@ def human_bytes(n: int) -> str:
     return f"{f:.2f} {units[i]}"
 
 
+def file_hexdigest(p: Path, algo) -> str:
+    # hashlib.file_digest (3.11+) runs the read/update loop in C
+    # with one preallocated buffer; older Pythons use the plain loop
+    with p.open("rb", buffering=0) as f:
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, algo).hexdigest()
+        h = hashlib.new(algo) if isinstance(algo, str) else algo()
+        buf = bytearray(READ_BUF)
+        view = memoryview(buf)
+        while n := f.readinto(buf):
+            h.update(view[:n])
+        return h.hexdigest()
+
+
 def sha256_file(p: Path) -> str:
-    h = hashlib.sha256()
-    with p.open("rb", buffering=1024*1024) as f:
-        for chunk in iter(lambda: f.read(1024*1024), b""):
-            h.update(chunk)
-    return h.hexdigest()
+    return file_hexdigest(p, SHA256)
+
+
+def digests(p: Path, want_md5: bool = False):
+    """(sha256, md5_or_none) from a single read of the file."""
+    if not want_md5:
+        return sha256_file(p), None
+    h1, h2 = new_sha256(), hashlib.md5()
+    buf = bytearray(READ_BUF)
+    view = memoryview(buf)
+    with p.open("rb", buffering=0) as f:
+        while n := f.readinto(buf):
+            h1.update(view[:n])
+            h2.update(view[:n])
+    return h1.hexdigest(), h2.hexdigest()
 
 
-def md5_file(p: Path) -> str:
-    h = hashlib.md5()
-    with p.open("rb", buffering=1024*1024) as f:
-        for chunk in iter(lambda: f.read(1024*1024), b""):
-            h.update(chunk)
-    return h.hexdigest()
+def _hash_one(p: Path, include_md5: bool = False):
+    # runs in a worker process: (path, sha256, md5_or_none, stat)
+    sha, md5 = digests(p, include_md5)
+    return p, sha, md5, p.stat()
+
+
+def hash_files(paths: list[Path], include_md5: bool = False):
+    """Hash files in parallel (one process per core), yielding results in input order."""
+    with ProcessPoolExecutor(max_workers=os.cpu_count()) as ex:
+        yield from ex.map(partial(_hash_one, include_md5=include_md5), paths, chunksize=4)
 
 
 def iter_files(base: Path):
-    for root, dirs, files in os.walk(base):
-        # prune skip dirs
-        dirs[:] = [
-            d for d in dirs if d not in SKIP_DIR_NAMES and not d.startswith(".")]
-        for name in files:
-            if name.startswith("."):
-                continue
-            p = Path(root) / name
-            if any(str(p).endswith(sfx) for sfx in SKIP_FILE_SUFFIXES):
+    """Yield os.DirEntry for every file (one scandir pass; entry.stat() is cached)."""
+    dirs = []
+    with os.scandir(base) as it:
+        for e in it:
+            if e.name.startswith("."):
                 continue
-            yield p
+            if e.is_dir():
+                # prune skip dirs; like os.walk, symlinked dirs are not followed
+                if e.name not in SKIP_DIR_NAMES and not e.is_symlink():
+                    dirs.append(e.path)
+            elif not e.name.endswith(tuple(SKIP_FILE_SUFFIXES)):
+                yield e
+    for d in dirs:
+        yield from iter_files(d)
+
+
+def read_manifest(mf_path: Path) -> dict[str, dict]:
+    """
+    Load manifest.jsonl into dict[path -> row].
+    A damaged manifest (e.g. truncated by an interrupted run) is ignored as a whole -> {}.
+    """
+    if not mf_path.exists():
+        return {}
+    try:
+        with mf_path.open("r", encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f]
+        out = {}
+        for r in rows:
+            # a row without the required keys means the file is not a manifest
+            if not isinstance(r, dict) or not {"path", "sha256", "size_bytes"} <= r.keys():
+                raise KeyError(f"row without path/sha256/size_bytes: {r}")
+            out[r["path"]] = r
+        return out
+    except (ValueError, KeyError, TypeError) as e:
+        print(f"[!] Ignoring damaged {mf_path.name}: {e}", file=sys.stderr)
+        return {}
+
+
+def load_manifest(mf_path: Path):
+    """Load manifest.jsonl into dict[path -> (sha256, md5_or_none, size_bytes)]."""
+    return {path: (r["sha256"], r.get("md5"), r["size_bytes"])
+            for path, r in read_manifest(mf_path).items()}
+
+
+def cached_digests(cache: dict, rel: str, st, include_md5: bool):
+    """(sha256, md5_or_none) from the previous manifest if size+mtime match, else None."""
+    r = cache.get(rel)
+    if r is None or r["size_bytes"] != st.st_size or r.get("mtime") != int(st.st_mtime):
+        return None
+    if include_md5 and "md5" not in r:
+        return None
+    return r["sha256"], (r.get("md5") if include_md5 else None)
 
 
 def load_checksums_table(md_path: Path):
@@ -105,7 +215,14 @@ def load_checksums_table(md_path: Path):
     return out
 
 
-def write_checksums_md(base: Path, rows: list[dict], include_md5: bool):
+def md_line(rel: str, size: int, sha256: str, md5: str | None) -> str:
+    if md5 is not None:
+        return f"| `{rel}` | {human_bytes(size)} | `{sha256}` | `{md5}` |\n"
+    return f"| `{rel}` | {human_bytes(size)} | `{sha256}` |\n"
+
+
+def write_checksums_md(base: Path, md_rows: list[tuple[str, str]], include_md5: bool):
+    """md_rows: (path_rel, preformatted table line), already sorted."""
     md = []
     md.append("# Checksums\n")
     md.append(f"Generated at: {time.strftime('%Y-%m-%d %H:%M:%S %Z')}\n")
@@ -116,29 +233,21 @@ def write_checksums_md(base: Path, rows: list[dict], include_md5: bool):
     else:
         md.append("| Path | Size | SHA256 |\n")
         md.append("|------|------|--------|\n")
-    for r in rows:
-        path_rel = r["path_rel"]
-        size_hr = r["size_hr"]
-        sha256 = r["sha256"]
-        if include_md5:
-            md5 = r.get("md5", "")
-            md.append(f"| `{path_rel}` | {size_hr} | `{sha256}` | `{md5}` |\n")
-        else:
-            md.append(f"| `{path_rel}` | {size_hr} | `{sha256}` |\n")
+    md.extend(line for _, line in md_rows)
     (base / CHECKSUMS_NAME).write_text("".join(md), encoding="utf-8")
 
 
-def append_manifest_jsonl(base: Path, rows: list[dict]):
-    mf = base / MANIFEST_NAME
-    with mf.open("a", encoding="utf-8") as f:
-        for r in rows:
-            f.write(json.dumps({
-                "path": r["path_rel"],
-                "size_bytes": r["size_bytes"],
-                "mtime": r["mtime"],
-                "sha256": r["sha256"],
-                **({"md5": r["md5"]} if "md5" in r else {}),
-            }) + "\n")
+def manifest_line(rel: str, size: int, mtime: int, sha256: str, md5: str | None) -> str:
+    # fixed schema: only the path needs JSON escaping, the rest is numbers/hex
+    line = (f'{{"path": {json.dumps(rel)}, "size_bytes": {size}, '
+            f'"mtime": {mtime}, "sha256": "{sha256}"')
+    if md5 is not None:
+        line += f', "md5": "{md5}"'
+    return line + "}\n"
+
+
+def append_manifest_jsonl(f, lines: list[str]):
+    f.writelines(lines)
 
 
 def main():
@@ -147,8 +256,10 @@ def main():
                     help="Base directory to scan")
     ap.add_argument("--include-md5", action="store_true",
                     help="Also compute MD5 (slower, optional)")
+    ap.add_argument("--force", action="store_true",
+                    help="Re-hash all files, ignoring the size+mtime cache from manifest.jsonl")
     ap.add_argument("--verify", action="store_true",
-                    help="Verify files against existing CHECKSUMS.md")
+                    help="Verify files against existing manifest.jsonl (fallback: CHECKSUMS.md)")
     args = ap.parse_args()
 
     base = Path(args.base).resolve()
@@ -158,18 +269,18 @@ def main():
 
     checksums_path = base / CHECKSUMS_NAME
     if args.verify:
-        # verify mode: compare SHA256 with table
-        ref = load_checksums_table(checksums_path)
+        # verify mode: compare SHA256 with manifest.jsonl (machine-readable);
+        # the Markdown table is only a fallback for older releases
+        ref = load_manifest(base / MANIFEST_NAME) or load_checksums_table(checksums_path)
         if not ref:
             print(
-                f"[!] No {CHECKSUMS_NAME} found at {checksums_path}", file=sys.stderr)
+                f"[!] No {MANIFEST_NAME} or {CHECKSUMS_NAME} found at {base}", file=sys.stderr)
             sys.exit(2)
         ok = 0
         bad = 0
         missing = 0
-        for p in iter_files(base):
+        for p, sha, _, _ in hash_files([Path(e.path) for e in iter_files(base)]):
             rel = str(p.relative_to(base))
-            sha = sha256_file(p)
             if rel not in ref:
                 print(f"[MISSING IN TABLE] {rel}")
                 missing += 1
@@ -186,55 +297,61 @@ def main():
         sys.exit(0 if bad == 0 else 1)
 
     # generate mode
-    # start fresh manifest
+    # previous manifest is the cache: unchanged files (size+mtime) are not re-hashed
     man = base / MANIFEST_NAME
+    cache = {} if args.force else read_manifest(man)
+    # start fresh manifest
     if man.exists():
         man.unlink()
 
-    rows_for_md: list[dict] = []
-    batch_for_manifest: list[dict] = []
+    # only (sort key, preformatted line) is kept per file
+    md_rows: list[tuple[str, str]] = []
+    batch_for_manifest: list[str] = []
 
-    total = 0
-    for p in iter_files(base):
-        total += 1
+    entries = list(iter_files(base))
+    paths = [Path(e.path) for e in entries]
+    stats = [e.stat() for e in entries]
+    total = len(paths)
     print(f"[i] Files to process: {total}")
 
+    hits = [cached_digests(cache, str(p.relative_to(base)), st, args.include_md5)
+            for p, st in zip(paths, stats)]
+    to_hash = [p for p, hit in zip(paths, hits) if hit is None]
+    print(f"[i] cached: {total - len(to_hash)}, hashed: {len(to_hash)}")
+    # results come back in to_hash order, so they interleave with cache hits in order
+    hashed = hash_files(to_hash, include_md5=args.include_md5)
+
     processed = 0
-    for p in iter_files(base):
-        processed += 1
-        rel = str(p.relative_to(base))
-        st = p.stat()
-        size = st.st_size
-        mtime = int(st.st_mtime)
-        sha = sha256_file(p)
-        row = {
-            "path_rel": rel,
-            "size_bytes": size,
-            "size_hr": human_bytes(size),
-            "mtime": mtime,
-            "sha256": sha,
-        }
-        if args.include_md5:
-            row["md5"] = md5_file(p)
-
-        rows_for_md.append(row)
-        batch_for_manifest.append(row)
-
-        # write manifest in chunks to avoid keeping everything in RAM
-        if len(batch_for_manifest) >= 200:
-            append_manifest_jsonl(base, batch_for_manifest)
-            batch_for_manifest.clear()
-
-        if processed % 50 == 0:
-            print(f"[=] {processed}/{total} ...")
-
-    # flush remainder
-    if batch_for_manifest:
-        append_manifest_jsonl(base, batch_for_manifest)
+    # manifest is opened once; rows are flushed in batches
+    with man.open("w", encoding="utf-8") as mf:
+        for p, st, hit in zip(paths, stats, hits):
+            processed += 1
+            rel = str(p.relative_to(base))
+            if hit is not None:
+                sha, md5 = hit
+            else:
+                _, sha, md5, st = next(hashed)
+            size = st.st_size
+            mtime = int(st.st_mtime)
+
+            md_rows.append((rel, md_line(rel, size, sha, md5)))
+            batch_for_manifest.append(manifest_line(rel, size, mtime, sha, md5))
+
+            # write manifest in chunks to avoid keeping everything in RAM
+            if len(batch_for_manifest) >= 200:
+                append_manifest_jsonl(mf, batch_for_manifest)
+                batch_for_manifest.clear()
+
+            if processed % 50 == 0:
+                print(f"[=] {processed}/{total} ...")
+
+        # flush remainder
+        if batch_for_manifest:
+            append_manifest_jsonl(mf, batch_for_manifest)
 
     # stable ordering in CHECKSUMS.md (alphabetical)
-    rows_for_md.sort(key=lambda r: r["path_rel"])
-    write_checksums_md(base, rows_for_md, include_md5=args.include_md5)
+    md_rows.sort(key=lambda t: t[0])
+    write_checksums_md(base, md_rows, include_md5=args.include_md5)
 
     print(f"[✓] Wrote {CHECKSUMS_NAME} and {MANIFEST_NAME} at {base}")
 